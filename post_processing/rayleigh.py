@@ -21,9 +21,12 @@
 import sys
 import os
 import mmap
+import struct
 import collections.abc
+import concurrent.futures
 import abc
 import copy
+import weakref
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -50,13 +53,49 @@ try:
         progress = tqdm.tqdm
 except ImportError:
 
-    def progress(x):
+    def progress(x, **kwargs):
         return x
 
 
 def get_bounds(a, start, end):
-    a = 0.5 * (a[:-1] + a[1:])
-    return np.concatenate([[start], a, [end]], axis=0)
+    out = np.empty(len(a) + 1)
+    out[0] = start
+    out[-1] = end
+    mid = out[1:-1]
+    np.add(a[:-1], a[1:], out=mid)
+    mid *= 0.5
+    return out
+
+
+def get_radius_bounds(r):
+    return get_bounds(r, r[0] + 0.5 * (r[0] - r[1]), r[-1] - 0.5 * (r[-2] - r[-1]))
+
+
+def unique_grids(*coords):
+    """returns, for each file, the index of the first file with an identical grid
+
+    coords: per-file lists of coordinate arrays describing the grid
+    """
+    first = {}
+    return [
+        first.setdefault(tuple(a.tobytes() for a in grid), i)
+        for i, grid in enumerate(zip(*coords))
+    ]
+
+
+def per_grid(func, ugrid, values):
+    """returns [func(v) for v in values], evaluated once per unique grid"""
+    out = {u: func(values[u]) for u in set(ugrid)}
+    return [out[u] for u in ugrid]
+
+
+def get_sintheta(costheta):
+    """returns sqrt(1 - costheta**2), working in a single buffer"""
+    s = np.square(costheta)
+    np.subtract(1.0, s, out=s)
+    # rounding may leave tiny negative values at the poles
+    np.maximum(s, 0.0, out=s)
+    return np.sqrt(s, out=s)
 
 
 def format_time(t: float, unit=None, digits=2, return_factor=False):
@@ -110,45 +149,134 @@ class BaseFile(object):
         else:
             raise IOError(f"could not determine endianness in file '{filename}'")
 
-    def __init__(self, filename: str, endian=None, memmap=use_mmap):
+    def __init__(self, filename: str, endian=None, memmap=use_mmap, populate=False):
+        """
+        populate: prefault the whole memory mapped file when opening it, for
+                  workloads that read all of it (Linux only)
+        """
         self.fh = open(filename, "rb")
         self._memmap = memmap
 
         if self._memmap:
-            buf = mmap.mmap(self.fh.fileno(), 0, mmap.MAP_SHARED, mmap.ACCESS_READ)
+            flags = mmap.MAP_SHARED
+            if populate:
+                # MAP_POPULATE is only exposed by Python >= 3.10
+                flags |= getattr(mmap, "MAP_POPULATE", 0)
+            buf = mmap.mmap(self.fh.fileno(), 0, flags, mmap.ACCESS_READ)
             self.fh.close()
             self.fh = buf
+            if populate and not hasattr(mmap, "MAP_POPULATE"):
+                self.advise(getattr(mmap, "MADV_WILLNEED", None))
 
         if endian is None:
             self.endian = self.get_endian(self.fh, 314, "i4", filename)
         else:
             self.endian = endian
+        self._need_swap = self.endian != ("<" if sys.byteorder == "little" else ">")
+        self._i4_fmt = self.endian + "i"
+        self._f8_fmt = self.endian + "d"
+        # With mmap the read position is tracked here rather than through
+        # tell/seek calls on the mmap object.
+        self._pos = self.fh.tell()
+
+    def tell(self):
+        return self._pos if self._memmap else self.fh.tell()
+
+    def seek(self, pos):
+        if self._memmap:
+            self._pos = pos
+        else:
+            self.fh.seek(pos)
+
+    # dtypes with byte order applied and the matching struct format for scalar
+    # reads, shared by all files
+    _dtype_cache = {}
+
+    def get_dtype(self, dtype, byteorder=None):
+        """returns the dtype with the byte order of the file and its struct format
+        byteorder: use this byte order instead of the one of the file
+        The format is None if the dtype cannot be read with struct.
+        """
+        if byteorder is None:
+            byteorder = self.endian
+        key = (dtype, byteorder)
+        if key not in self._dtype_cache:
+            d = np.dtype(dtype).newbyteorder(byteorder)
+            fmt = byteorder + d.char
+            try:
+                if struct.calcsize(fmt) != d.itemsize:
+                    fmt = None
+            except struct.error:
+                fmt = None
+            self._dtype_cache[key] = (d, fmt)
+        return self._dtype_cache[key]
 
     def get_value(self, dtype: str, shape=None):
-        dtype = np.dtype(dtype).newbyteorder(self.endian)
+        dtype, fmt = self.get_dtype(dtype)
         if shape is None:
-            scalar = True
-            shape = [1]
-        else:
-            scalar = False
-        size = np.product(shape)
+            if fmt is not None:
+                return self._read_scalar(fmt, dtype.itemsize)
+            shape = ()
+        size = int(np.prod(shape))
         if self._memmap:
             out = np.ndarray(
                 shape,
                 dtype=dtype,
                 buffer=self.fh,
-                offset=self.fh.tell(),
+                offset=self._pos,
                 order="F",
             )
-            self.fh.seek(dtype.itemsize * size, os.SEEK_CUR)
+            self._pos += dtype.itemsize * size
         else:
             out = np.fromfile(self.fh, dtype=dtype, count=size)
-            out.shape = shape
-        if scalar:
-            return out[0]
+            if self._need_swap:
+                # Swap once on load, so later operations work on native data.
+                native, _ = self.get_dtype(dtype, "=")
+                out = out.byteswap(inplace=True).view(native)
+            out = out.reshape(shape, order="F")
+        if out.ndim == 0:
+            return out[()]
         else:
             return out
 
+    def _read_scalar(self, fmt, size):
+        if self._memmap:
+            # read directly from the mapped buffer without copying
+            (x,) = struct.unpack_from(fmt, self.fh, self._pos)
+            self._pos += size
+        else:
+            (x,) = struct.unpack(fmt, self.fh.read(size))
+        return x
+
+    def _read_i4(self):
+        return self._read_scalar(self._i4_fmt, 4)
+
+    def _read_f8(self):
+        return self._read_scalar(self._f8_fmt, 8)
+
+    @staticmethod
+    def native(a):
+        """returns a in native byte order, only copying it if necessary
+        Values read with mmap keep the byte order of the file.
+        """
+        if a.dtype.isnative:
+            return a
+        return a.astype(a.dtype.newbyteorder("="))
+
+    def advise(self, option, start=0, length=None):
+        """passes the madvise hint option for the given range of the file
+        This does nothing if the file is not memory mapped or the hint is not
+        available on this platform.
+        """
+        if not self._memmap or option is None or not hasattr(self.fh, "madvise"):
+            return
+        if length is None:
+            length = len(self.fh) - start
+        # the start of the range has to be aligned to pages
+        shift = start % mmap.PAGESIZE
+        if length > 0:
+            self.fh.madvise(option, start - shift, length + shift)
+
     @property
     def qvmap(self):
         return {v: i for i, v in enumerate(self.qv)}
@@ -172,11 +300,156 @@ class Spherical_3D_grid(BaseFile):
         self.phi = 0.5 * (self.phi_bounds[1:] + self.phi_bounds[:-1])
 
 
-class Spherical_3D_value(np.ndarray):
-    def __new__(cls, filename, nr, ntheta, nphi, endian, **kwargs):
-        f = BaseFile(filename, endian=endian, **kwargs)
+class Spherical_3D_value(np.lib.mixins.NDArrayOperatorsMixin):
+    """[nphi, ntheta, nr] volume of one quantity that is only read on access
+    With mmap the data is a view of the file. Without it, indexing only reads
+    the radial levels that are selected instead of the whole volume.
+    """
 
-        return f.get_value("f8", shape=[nphi, ntheta, nr]).view(type=cls)
+    def __init__(self, filename, nr, ntheta, nphi, endian, **kwargs):
+        self.filename = filename
+        self.shape = (nphi, ntheta, nr)
+        self.endian = endian
+        self._kwargs = kwargs
+        self._memmap = kwargs.get("memmap", use_mmap)
+        self._file = None
+        self._data = None
+        self._sequential = False
+
+    def _open(self):
+        f = BaseFile(self.filename, endian=self.endian, **self._kwargs)
+        self._offset = f.tell()
+        return f
+
+    @property
+    def file(self):
+        """the memory mapped file, which stays open as the data is a view of it"""
+        if self._file is None:
+            self._file = self._open()
+        return self._file
+
+    def _read(self, start, shape):
+        """returns values of the given shape, starting at value start
+        Without mmap, the file is only open while reading.
+        """
+        f = self.file if self._memmap else self._open()
+        try:
+            f.seek(self._offset + 8 * start)
+            return f.get_value("f8", shape=list(shape))
+        finally:
+            if not self._memmap:
+                f.fh.close()
+
+    def _volume(self):
+        if self._data is None:
+            self._data = self._read(0, self.shape)
+        return self._data
+
+    @property
+    def data(self):
+        if self._memmap and not self._sequential:
+            # the whole volume is about to be used, usually in file order
+            self.file.advise(getattr(mmap, "MADV_SEQUENTIAL", None))
+            self._sequential = True
+        return self._volume()
+
+    @property
+    def dtype(self):
+        # values are only converted to native byte order when read without mmap
+        return np.dtype(self.endian + "f8" if self._memmap else "f8")
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def native(self):
+        return BaseFile.native(self.data)
+
+    def to_cupy(self):
+        """returns the data as a CuPy array on the current GPU
+        The data is copied into pinned host memory first, so that it is sent to
+        the device in a single transfer.
+        """
+        import cupy
+
+        pinned = cupy.cuda.alloc_pinned_memory(8 * int(np.prod(self.shape)))
+        staged = np.ndarray(self.shape, dtype="f8", buffer=pinned, order="F")
+        # converts to native byte order on the way
+        staged[...] = self.data
+        out = cupy.empty(self.shape, dtype="f8", order="F")
+        out.set(staged)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        if copy:
+            return np.array(self.data, dtype=dtype, copy=True)
+        return np.asarray(self.data, dtype=dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [x.data if isinstance(x, Spherical_3D_value) else x for x in inputs]
+        if "out" in kwargs:
+            kwargs["out"] = tuple(
+                x.data if isinstance(x, Spherical_3D_value) else x
+                for x in kwargs["out"]
+            )
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __getattr__(self, name):
+        # everything else (mean, sum, T, ...) is taken from the data array
+        if name.startswith("_") or name in ("data", "file"):
+            raise AttributeError(name)
+        return getattr(self.data, name)
+
+    def __getitem__(self, ind):
+        if self._data is not None or self._memmap:
+            # only part of the volume may be used, so no access pattern is hinted
+            return self._volume()[ind]
+
+        if not isinstance(ind, tuple):
+            ind = (ind,)
+        simple = (int, np.integer, slice)
+        basic = [
+            i is Ellipsis or (isinstance(i, simple) and not isinstance(i, bool))
+            for i in ind
+        ]
+        nellipsis = sum(i is Ellipsis for i in ind)
+        if not all(basic) or nellipsis > 1 or len(ind) - nellipsis > 3:
+            return self.data[ind]
+        if nellipsis:
+            k = [i is Ellipsis for i in ind].index(True)
+            ind = ind[:k] + (slice(None),) * (4 - len(ind)) + ind[k + 1 :]
+        ind = ind + (slice(None),) * (3 - len(ind))
+
+        # The radial index varies slowest in the file, so each radial level is
+        # a contiguous slab that can be read on its own.
+        nphi, ntheta, nr = self.shape
+        ir = ind[2]
+        if isinstance(ir, (int, np.integer)):
+            if not -nr <= ir < nr:
+                raise IndexError(
+                    f"index {ir} is out of bounds for axis 2 with size {nr}"
+                )
+            start, stop = ir % nr, ir % nr + 1
+            ir = 0
+        elif isinstance(ir, slice) and ir.step in (None, 1):
+            start, stop, _ = ir.indices(nr)
+            stop = max(start, stop)
+            ir = slice(None)
+        else:
+            return self.data[ind]
+        if stop - start == nr:
+            # all of the volume is needed, so read it once and keep it
+            return self.data[ind]
+
+        slab = self._read(nphi * ntheta * start, (nphi, ntheta, stop - start))
+        return slab[ind[0], ind[1], ir]
 
 
 class Spherical_3D_TimeSeries(TimeSeries):
@@ -186,12 +459,28 @@ class Spherical_3D_TimeSeries(TimeSeries):
         self.directory = directory
         self.qcode = qcode
         self.iter = i
+        self._grid = None
+
+    def get_grid(self, i):
+        """returns the grid of snapshot i
+        The grid is usually the same for all snapshots of a run, so the last one
+        read is reused as long as the header of grid file i matches it.
+        """
+        f = os.path.join(self.directory, "{:08d}_grid".format(i))
+        grid = self._grid
+        if grid is not None:
+            with open(f, "rb") as fh:
+                endian = BaseFile.get_endian(fh, 314, "i4", f)
+                dims = tuple(np.frombuffer(fh.read(12), dtype=endian + "i4"))
+            if endian == grid.endian and dims == (grid.nr, grid.ntheta, grid.nphi):
+                return grid
+        grid = self._grid = Spherical_3D_grid(f)
+        return grid
 
     def __getitem__(self, ind):
         def getone(i):
-            f = os.path.join(self.directory, "{:08d}_grid".format(i))
-            grid = Spherical_3D_grid(f)
             f = os.path.join(self.directory, "{:08d}_{:04d}".format(i, self.qcode))
+            grid = self.get_grid(i)
             return Spherical_3D_value(
                 f, grid.nr, grid.ntheta, grid.nphi, endian=grid.endian
             )
@@ -203,9 +492,15 @@ class Spherical_3D_TimeSeries(TimeSeries):
 
 
 class Spherical_3D_Snapshot(object):
-    def __init__(self, directory, snap):
+    def __init__(self, directory, snap, device=None):
+        """
+        device: "cuda" to return quantities as CuPy arrays on the GPU
+        """
+        if device not in (None, "cpu", "cuda"):
+            raise ValueError("unknown device '{}'".format(device))
         self.directory = directory
         self.snap = snap
+        self.device = device
 
         f = os.path.join(self.directory, "{:08d}_grid".format(snap))
         grid = Spherical_3D_grid(f)
@@ -216,15 +511,32 @@ class Spherical_3D_Snapshot(object):
 
         self.endian = grid.endian
 
+        # values that are still in use, so that accessing a quantity again
+        # reuses its mapping or the data read so far
+        self._values = weakref.WeakValueDictionary()
+        # quantities already copied to the device, so that they are sent once
+        self._device_values = {}
+
     def q(self, q):
-        f = os.path.join(self.directory, "{:08d}_{:04d}".format(self.snap, q))
-        return Spherical_3D_value(
-            f,
-            len(self.radius),
-            len(self.theta),
-            len(self.phi),
-            endian=self.endian,
-        )
+        if self.device == "cuda":
+            if q not in self._device_values:
+                self._device_values[q] = self._value(q).to_cupy()
+            return self._device_values[q]
+        return self._value(q)
+
+    def _value(self, q):
+        value = self._values.get(q)
+        if value is None:
+            f = os.path.join(self.directory, "{:08d}_{:04d}".format(self.snap, q))
+            value = Spherical_3D_value(
+                f,
+                len(self.radius),
+                len(self.theta),
+                len(self.phi),
+                endian=self.endian,
+            )
+            self._values[q] = value
+        return value
 
     def __getattr__(self, q):
         qcode = lut.parse_quantity(q)[0]
@@ -238,25 +550,21 @@ class Spherical_3D(object):
         super().__init__()
 
         self.directory = directory
-        files = os.listdir(directory)
-        self.iter = set()
-        self.quants = set()
-
-        for f in progress(files):
-            snap, quant = f.split("_")
-            if quant == "grid":
-                continue
-            s = int(snap)
-            q = int(quant)
-            assert "{:08d}".format(s) == snap
-            assert "{:04d}".format(q) == quant
-            self.iter.add(s)
-            self.quants.add(q)
-
-        self.iter = list(self.iter)
-        self.iter.sort()
-        self.quants = list(self.quants)
-        self.quants.sort()
+        with os.scandir(directory) as it:
+            files = np.array([e.name for e in it], dtype=str)
+        files = files[~np.char.endswith(files, "_grid")]
+
+        # Parse all "{snap:08d}_{quant:04d}" file names at once.
+        assert np.all(np.char.str_len(files) == 13)
+        chars = files.astype("U13").view("U1").reshape(-1, 13)
+        snaps = files.astype("U8")
+        quants = np.ascontiguousarray(chars[:, 9:]).view("U4").ravel()
+        assert np.all(
+            np.char.isdigit(snaps) & np.char.isdigit(quants) & (chars[:, 8] == "_")
+        )
+
+        self.iter = np.unique(snaps.astype(np.int64)).tolist()
+        self.quants = np.unique(quants.astype(np.int32)).tolist()
 
     def q(self, q):
         return Spherical_3D_TimeSeries(self.directory, q, self.iter)
@@ -323,6 +631,9 @@ class Rayleigh_TimeStep(object):
 
 
 class Rayleigh_Output(collections.abc.Sequence):
+    # keep the objects of the files read in self._files
+    keep_files = False
+
     @abc.abstractmethod
     def get_q(self, i, qcode):
         pass
@@ -362,12 +673,18 @@ class Rayleigh_Output(collections.abc.Sequence):
         else:
             return set(lut.parse_quantities(qs)[1])
 
-    def __init__(self, filecls, directory, subrange=None):
+    def __init__(self, filecls, directory, subrange=None, **kwargs):
+        """
+        filecls: class reading a single output file
+        directory: output directory
+        subrange: only read these files (a slice or a stride)
+        kwargs: passed on to filecls, e.g. memmap or populate
+        """
         super().__init__()
 
         self.directory = directory
-        files = os.listdir(directory)
-        files.sort()
+        with os.scandir(directory) as it:
+            files = sorted(e.name for e in it)
 
         if subrange is not None:
             if isinstance(subrange, int):
@@ -375,23 +692,75 @@ class Rayleigh_Output(collections.abc.Sequence):
             files = files[subrange]
 
         self.val = []
-        self.time = []
-        self.iter = []
-        self.gridpointer = []
-
-        for a in self.attrs:
-            setattr(self, a, [])
-
-        for i, f in enumerate(progress(files)):
-            m = filecls(os.path.join(directory, f))
-            self.val += m.val
-            self.time += m.time
-            self.iter += m.iter
-
-            self.gridpointer += len(m.val) * [i]
-
-            for a in self.attrs:
-                getattr(self, a).append(getattr(m, a))
+        # per-file chunks, joined into contiguous arrays once all files are read
+        times = [np.empty(0, dtype="f8")]
+        iters = [np.empty(0, dtype="i4")]
+        nrec = []
+
+        # per-file attributes, collected into one list each
+        attrs = [(a, []) for a in self.attrs]
+        self._files = []
+
+        def read(f):
+            return filecls(os.path.join(directory, f), **kwargs)
+
+        # Reading is mostly I/O and NumPy, which release the GIL, so files are
+        # read in parallel and collected in order.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            ms = ex.map(read, files)
+            # a bar is only worth its refresh cost when there are many files
+            bar = progress(
+                ms,
+                total=len(files),
+                mininterval=0.5,
+                smoothing=0.1,
+                disable=len(files) < 200,
+            )
+            for m in bar:
+                self.val += m.val
+                times.append(np.asarray(m.time, dtype="f8"))
+                iters.append(np.asarray(m.iter, dtype="i4"))
+                nrec.append(len(m.val))
+
+                for a, values in attrs:
+                    values.append(getattr(m, a))
+                if self.keep_files:
+                    self._files.append(m)
+
+        for a, values in attrs:
+            setattr(self, a, values)
+
+        self.time = np.concatenate(times)
+        self.iter = np.concatenate(iters)
+        # a list, as get_q indexes it with one scalar at a time
+        self.gridpointer = np.repeat(np.arange(len(nrec)), nrec).tolist()
+
+        # Files written with the same quantities share a column of the table,
+        # which holds the column of each quantity code in their values, or -1.
+        layouts = {}
+        self._qlayout = np.array(
+            [layouts.setdefault(tuple(d.items()), len(layouts)) for d in self.qvmap],
+            dtype=np.int32,
+        )
+        nqcode = max((max(d) + 1 for d in self.qvmap if d), default=0)
+        self._qv_to_col = np.full((nqcode, len(layouts)), -1, dtype=np.int32)
+        for items, k in layouts.items():
+            for qcode, col in items:
+                self._qv_to_col[qcode, k] = col
+        # _qcol looks columns up in Python lists, as NumPy scalar indexing is
+        # slow in comparison. Files with the same layout share one list.
+        layout_cols = self._qv_to_col.T.tolist()
+        self._file_cols = [layout_cols[k] for k in self._qlayout.tolist()]
+
+    def _qcol(self, qcode, igrid):
+        """returns the column of quantity qcode in the values of file igrid"""
+        try:
+            col = self._file_cols[igrid][qcode]
+        except IndexError:
+            col = -1
+        if col < 0 or qcode < 0:
+            raise KeyError(qcode)
+        return col
 
 
 class Plot2D(abc.ABC):
@@ -481,43 +850,47 @@ class Plot1D(abc.ABC):
 
 
 class Meridional_Slices_file(BaseFile):
-    def __init__(self, filename, **kwargs):
+    def __init__(self, filename, precision="f8", **kwargs):
+        """
+        precision: dtype the values are stored in, e.g. "f4" to halve the memory
+                   used when the values are only plotted
+        """
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
 
-        self.nr = self.get_value("i4")
-        self.ntheta = self.get_value("i4")
-        self.nphi = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.nr = self._read_i4()
+        self.ntheta = self._read_i4()
+        self.nphi = self._read_i4()
+        self.nq = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
-        self.radius = r = self.get_value("f8", shape=[self.nr])
-        self.radius_bounds = get_bounds(
-            r, r[0] + 0.5 * (r[0] - r[1]), r[-1] - 0.5 * (r[-2] - r[-1])
-        )
+        self.radius = self.get_value("f8", shape=[self.nr])
+        self.radius_bounds = get_radius_bounds(self.radius)
         self.costheta = self.get_value("f8", shape=[self.ntheta])
-        self.sintheta = np.sqrt(1.0 - self.costheta**2)
+        self.sintheta = get_sintheta(self.costheta)
         self.phi_inds = self.get_value("i4", shape=[self.nphi]) - 1
-        if self.nphi == 1:
-            self.phi_inds = np.array([self.phi_inds])
-        self.phi = np.zeros(self.nphi, dtype="float64")
 
         dphi = (2 * np.pi) / (self.ntheta * 2)
-        for i in range(self.nphi):
-            self.phi[i] = self.phi_inds[i] * dphi
-
-        self.val = []
-        self.time = []
-        self.iter = []
-        for i in range(self.nrec):
-            self.val.append(
-                self.get_value("f8", shape=[self.nphi, self.ntheta, self.nr, self.nq])
-            )
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+        self.phi = self.phi_inds.astype("float64") * dphi
+
+        # Read all records at once. Subarrays are stored in C order, so the
+        # Fortran-ordered [nphi, ntheta, nr, nq] values are transposed.
+        rec = np.dtype(
+            [
+                ("val", "f8", (self.nq, self.nr, self.ntheta, self.nphi)),
+                ("time", "f8"),
+                ("iter", "i4"),
+            ]
+        )
+        buf = self.get_value(rec, shape=[self.nrec])
+        self.val = [v.T for v in buf["val"]]
+        if np.dtype(precision) != np.dtype("f8"):
+            self.val = [v.astype(precision) for v in self.val]
+        self.time = buf["time"]
+        self.iter = buf["iter"]
 
 
 class Meridional_Slices(Rayleigh_Output, Plot2D):
@@ -526,38 +899,48 @@ class Meridional_Slices(Rayleigh_Output, Plot2D):
     def __init__(self, directory="Meridional_Slices", **kwargs):
         super().__init__(Meridional_Slices_file, directory, **kwargs)
 
-        self.theta = [np.arccos(x) for x in self.costheta]
-        self.costheta_bounds = [np.cos(get_bounds(t, np.pi, 0.0)) for t in self.theta]
-        self.sintheta_bounds = [np.sqrt(1.0 - ct**2) for ct in self.costheta_bounds]
-        self.radius_bounds = [
-            get_bounds(r, r[0] + 0.5 * (r[0] - r[1]), r[-1] - 0.5 * (r[-2] - r[-1]))
-            for r in self.radius
-        ]
+        # files usually share a grid, so bounds are only computed once per grid
+        self._ugrid = unique_grids(self.costheta, self.radius)
+        self.theta = per_grid(np.arccos, self._ugrid, self.costheta)
+        self.costheta_bounds = per_grid(
+            lambda t: np.cos(get_bounds(t, np.pi, 0.0)), self._ugrid, self.theta
+        )
+        self.sintheta_bounds = per_grid(get_sintheta, self._ugrid, self.costheta_bounds)
+        self.radius_bounds = per_grid(get_radius_bounds, self._ugrid, self.radius)
+        # coordinates per unique grid, computed when first plotted
+        self._coords = {}
 
     def get_coords(self, i):
         igrid = self.gridpointer[i]
-        X = self.sintheta_bounds[igrid][:, None] * self.radius_bounds[igrid][None, :]
-        Y = self.costheta_bounds[igrid][:, None] * self.radius_bounds[igrid][None, :]
-        return X, Y
+        u = self._ugrid[igrid]
+        if u not in self._coords:
+            r = self.radius_bounds[u]
+            X = np.multiply.outer(self.sintheta_bounds[u], r)
+            Y = np.multiply.outer(self.costheta_bounds[u], r)
+            # shared by all calls, so they must not be modified in place
+            X.flags.writeable = False
+            Y.flags.writeable = False
+            self._coords[u] = (X, Y)
+        return self._coords[u]
 
     def get_coord_labels(self):
         return "$x$", "$y$"
 
     def get_q(self, i, qcode):
         igrid = self.gridpointer[i]
-        return self.val[i][:, :, :, self.qvmap[igrid][qcode]]
+        return self.val[i][:, :, :, self._qcol(qcode, igrid)]
 
 
 class Equatorial_Slices_file(BaseFile):
-    def __init__(self, filename, **kwargs):
+    def __init__(self, filename, precision="f8", **kwargs):
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
 
-        self.nphi = self.get_value("i4")
-        self.nr = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.nphi = self._read_i4()
+        self.nr = self._read_i4()
+        self.nq = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
@@ -566,13 +949,21 @@ class Equatorial_Slices_file(BaseFile):
         dphi = 2 * np.pi / self.nphi
         self.phi = np.arange(self.nphi) * dphi
 
-        self.val = []
-        self.time = []
-        self.iter = []
-        for i in range(self.nrec):
-            self.val.append(self.get_value("f8", shape=[self.nphi, self.nr, self.nq]))
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+        # Read all records at once, see Meridional_Slices_file for this and
+        # precision.
+        rec = np.dtype(
+            [
+                ("val", "f8", (self.nq, self.nr, self.nphi)),
+                ("time", "f8"),
+                ("iter", "i4"),
+            ]
+        )
+        buf = self.get_value(rec, shape=[self.nrec])
+        self.val = [v.T for v in buf["val"]]
+        if np.dtype(precision) != np.dtype("f8"):
+            self.val = [v.astype(precision) for v in self.val]
+        self.time = buf["time"]
+        self.iter = buf["iter"]
 
 
 class Equatorial_Slices(Rayleigh_Output, Plot2D):
@@ -581,44 +972,55 @@ class Equatorial_Slices(Rayleigh_Output, Plot2D):
     def __init__(self, directory="Equatorial_Slices", **kwargs):
         super().__init__(Equatorial_Slices_file, directory, **kwargs)
 
-        self.phi_bounds = [get_bounds(p, 0.0, 2.0 * np.pi) for p in self.phi]
-        self.radius_bounds = [
-            get_bounds(r, r[0] + 0.5 * (r[0] - r[1]), r[-1] - 0.5 * (r[-2] - r[-1]))
-            for r in self.radius
-        ]
+        # files usually share a grid, so bounds are only computed once per grid
+        self._ugrid = unique_grids(self.phi, self.radius)
+        self.phi_bounds = per_grid(
+            lambda p: get_bounds(p, 0.0, 2.0 * np.pi), self._ugrid, self.phi
+        )
+        self.radius_bounds = per_grid(get_radius_bounds, self._ugrid, self.radius)
+        # coordinates per unique grid, computed when first plotted
+        self._coords = {}
 
     def get_coords(self, i):
         igrid = self.gridpointer[i]
-        X = np.cos(self.phi_bounds[igrid][:, None]) * self.radius_bounds[igrid][None, :]
-        Y = np.sin(self.phi_bounds[igrid][:, None]) * self.radius_bounds[igrid][None, :]
-        return X, Y
+        u = self._ugrid[igrid]
+        if u not in self._coords:
+            p = self.phi_bounds[u]
+            r = self.radius_bounds[u]
+            X = np.multiply.outer(np.cos(p), r)
+            Y = np.multiply.outer(np.sin(p), r)
+            # shared by all calls, so they must not be modified in place
+            X.flags.writeable = False
+            Y.flags.writeable = False
+            self._coords[u] = (X, Y)
+        return self._coords[u]
 
     def get_coord_labels(self):
         return "$x$", "$y$"
 
     def get_q(self, i, qcode):
         igrid = self.gridpointer[i]
-        return self.val[i][None, :, :, self.qvmap[igrid][qcode]]
+        return self.val[i][None, :, :, self._qcol(qcode, igrid)]
 
 
 class Point_Probes_file(BaseFile):
     def __init__(self, filename, **kwargs):
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
 
-        self.nr = self.get_value("i4")
-        self.ntheta = self.get_value("i4")
-        self.nphi = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.nr = self._read_i4()
+        self.ntheta = self._read_i4()
+        self.nphi = self._read_i4()
+        self.nq = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
         self.radius = self.get_value("f8", shape=[self.nr])
         self.rad_inds = self.get_value("i4", shape=[self.nr]) - 1
         self.costheta = self.get_value("f8", shape=[self.ntheta])
-        self.sintheta = np.sqrt(1.0 - self.costheta**2)
+        self.sintheta = get_sintheta(self.costheta)
         self.theta_inds = self.get_value("i4", shape=[self.ntheta]) - 1
         self.phi = self.get_value("f8", shape=[self.nphi])
         self.phi_inds = self.get_value("i4", shape=[self.nphi]) - 1
@@ -630,8 +1032,8 @@ class Point_Probes_file(BaseFile):
             self.val.append(
                 self.get_value("f8", shape=[self.nphi, self.ntheta, self.nr, self.nq])
             )
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+            self.time.append(self._read_f8())
+            self.iter.append(self._read_i4())
 
 
 class Point_Probes(Rayleigh_Output):
@@ -644,33 +1046,33 @@ class Point_Probes(Rayleigh_Output):
 
     def get_q(self, i, qcode):
         igrid = self.gridpointer[i]
-        return self.val[i][:, :, :, self.qvmap[igrid][qcode]]
+        return self.val[i][:, :, :, self._qcol(qcode, igrid)]
 
 
 class AZ_Avgs_file(BaseFile):
     def __init__(self, filename, **kwargs):
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
 
-        self.nr = self.get_value("i4")
-        self.ntheta = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.nr = self._read_i4()
+        self.ntheta = self._read_i4()
+        self.nq = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
         self.radius = self.get_value("f8", shape=[self.nr])
         self.costheta = self.get_value("f8", shape=[self.ntheta])
-        self.sintheta = np.sqrt(1.0 - self.costheta**2)
+        self.sintheta = get_sintheta(self.costheta)
 
         self.val = []
         self.time = []
         self.iter = []
         for i in range(self.nrec):
             self.val.append(self.get_value("f8", shape=[self.ntheta, self.nr, self.nq]))
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+            self.time.append(self._read_f8())
+            self.iter.append(self._read_i4())
 
 
 class AZ_Avgs(Rayleigh_Output, Plot2D):
@@ -681,11 +1083,8 @@ class AZ_Avgs(Rayleigh_Output, Plot2D):
 
         self.theta = [np.arccos(x) for x in self.costheta]
         self.costheta_bounds = [np.cos(get_bounds(t, np.pi, 0.0)) for t in self.theta]
-        self.sintheta_bounds = [np.sqrt(1.0 - ct**2) for ct in self.costheta_bounds]
-        self.radius_bounds = [
-            get_bounds(r, r[0] + 0.5 * (r[0] - r[1]), r[-1] - 0.5 * (r[-2] - r[-1]))
-            for r in self.radius
-        ]
+        self.sintheta_bounds = [get_sintheta(ct) for ct in self.costheta_bounds]
+        self.radius_bounds = [get_radius_bounds(r) for r in self.radius]
 
     def get_coords(self, i):
         igrid = self.gridpointer[i]
@@ -698,52 +1097,95 @@ class AZ_Avgs(Rayleigh_Output, Plot2D):
 
     def get_q(self, i, qcode):
         igrid = self.gridpointer[i]
-        return self.val[i][None, :, :, self.qvmap[igrid][qcode]]
+        return self.val[i][None, :, :, self._qcol(qcode, igrid)]
 
 
 class Shell_Slices_file(BaseFile):
-    def __init__(self, filename, **kwargs):
+    def __init__(self, filename, precision="f8", **kwargs):
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
 
-        self.ntheta = self.get_value("i4")
+        self.ntheta = self._read_i4()
         self.nphi = 2 * self.ntheta
-        self.nr = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.nr = self._read_i4()
+        self.nq = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
         self.radius = self.get_value("f8", shape=[self.nr])
         self.inds = self.get_value("i4", shape=[self.nr]) - 1
         self.costheta = self.get_value("f8", shape=[self.ntheta])
-        self.sintheta = np.sqrt(1.0 - self.costheta**2)
+        self.sintheta = get_sintheta(self.costheta)
 
         dphi = 2 * np.pi / self.nphi
         self.phi = np.arange(self.nphi) * dphi
 
-        self.val = []
-        self.time = []
-        self.iter = []
-        for i in range(self.nrec):
-            self.val.append(
-                self.get_value("f8", shape=[self.nphi, self.ntheta, self.nr, self.nq])
+        # Read all records at once, see Meridional_Slices_file for this and
+        # precision.
+        rec = np.dtype(
+            [
+                ("val", "f8", (self.nq, self.nr, self.ntheta, self.nphi)),
+                ("time", "f8"),
+                ("iter", "i4"),
+            ]
+        )
+        self._record_start = self.tell()
+        self._record_bytes = rec.itemsize
+        self._prefetched = None
+        buf = self.get_value(rec, shape=[self.nrec])
+        self.val = [v.T for v in buf["val"]]
+        # whether the values are views of the memory mapped file
+        self._mapped = self._memmap
+        if np.dtype(precision) != np.dtype("f8"):
+            self.val = [v.astype(precision) for v in self.val]
+            self._mapped = False
+        self.time = buf["time"]
+        self.iter = buf["iter"]
+
+        if not self._memmap:
+            # everything has been read
+            self.fh.close()
+
+    def record(self, i):
+        """returns the values of record i
+        With mmap, the pages of record i are prefetched and those of the record
+        prefetched before are released, so that stepping through a file only
+        keeps about one record in memory.
+        """
+        if self._mapped and i != self._prefetched:
+            if self._prefetched is not None:
+                self.advise(
+                    getattr(mmap, "MADV_DONTNEED", None),
+                    self._record_start + self._prefetched * self._record_bytes,
+                    self._record_bytes,
+                )
+            self.advise(
+                getattr(mmap, "MADV_WILLNEED", None),
+                self._record_start + i * self._record_bytes,
+                self._record_bytes,
             )
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+            self._prefetched = i
+        return self.val[i]
 
 
 class Shell_Slices(Rayleigh_Output, Plot2D):
     attrs = ("radius", "costheta", "sintheta", "phi", "qvmap")
+    keep_files = True
 
     def __init__(self, directory="Shell_Slices", **kwargs):
         super().__init__(Shell_Slices_file, directory, **kwargs)
 
+        # index of the first record of each file
+        self._first = np.searchsorted(
+            self.gridpointer, np.arange(len(self._files))
+        ).tolist()
+
         self.theta = [np.arccos(x) for x in self.costheta]
         self.theta_bounds = [get_bounds(t, np.pi, 0.0) for t in self.theta]
         self.costheta_bounds = [np.cos(t) for t in self.theta_bounds]
-        self.sintheta_bounds = [np.sqrt(1.0 - ct**2) for ct in self.costheta_bounds]
+        self.sintheta_bounds = [get_sintheta(ct) for ct in self.costheta_bounds]
         self.phi_bounds = [get_bounds(p, 0.0, 2.0 * np.pi) for p in self.phi]
 
     def get_coords(self, i):
@@ -767,8 +1209,11 @@ class Shell_Slices(Rayleigh_Output, Plot2D):
         return r"$\phi$", r"$\theta$"
 
     def get_q(self, i, qcode):
+        if i < 0:
+            i += len(self)
         igrid = self.gridpointer[i]
-        x = self.val[i][:, :, :, self.qvmap[igrid][qcode]]
+        x = self._files[igrid].record(i - self._first[igrid])
+        x = x[:, :, :, self._qcol(qcode, igrid)]
         # Move radial coordinate to first position so it can be selected in pcolor.
         return np.moveaxis(x, 2, 0)
 
@@ -777,12 +1222,12 @@ class SPH_Modes_file(BaseFile):
     def __init__(self, filename, **kwargs):
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
 
-        self.nell = self.get_value("i4")
-        self.nr = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.nell = self._read_i4()
+        self.nr = self._read_i4()
+        self.nq = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
@@ -811,8 +1256,8 @@ class SPH_Modes_file(BaseFile):
                 # The m>0 --power-- is too high by a factor of 2
                 # We divide the --complex amplitude-- by sqrt(2)
                 self.vals[-1][1:, :, :, :] /= np.sqrt(2.0)
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+            self.time.append(self._read_f8())
+            self.iter.append(self._read_i4())
 
 
 class SPH_Modes(Rayleigh_Output):
@@ -823,21 +1268,21 @@ class SPH_Modes(Rayleigh_Output):
 
     def get_q(self, i, qcode):
         igrid = self.gridpointer[i]
-        return self.val[i][:, :, :, self.qvmap[igrid][qcode]]
+        return self.val[i][:, :, :, self._qcol(qcode, igrid)]
 
 
 class Shell_Avgs_file(BaseFile):
     def __init__(self, filename, **kwargs):
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
 
-        self.nr = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.nr = self._read_i4()
+        self.nq = self._read_i4()
 
         if self.version >= 6:
-            npcol = self.get_value("i4")
+            npcol = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
@@ -865,8 +1310,8 @@ class Shell_Avgs_file(BaseFile):
                         "f8", shape=[nrout, 4, self.nq]
                     )
                     rind = rind + nrout
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+            self.time.append(self._read_f8())
+            self.iter.append(self._read_i4())
 
 
 class Shell_Avgs(Rayleigh_Output, Plot1D):
@@ -883,7 +1328,7 @@ class Shell_Avgs(Rayleigh_Output, Plot1D):
 
     def get_q(self, i, qcode):
         igrid = self.gridpointer[i]
-        x = self.val[i][:, :, self.qvmap[igrid][qcode]]
+        x = self.val[i][:, :, self._qcol(qcode, igrid)]
         # Move radial coordinate to first position so it can be selected in plot.
         return np.moveaxis(x, 1, 0)
 
@@ -892,9 +1337,9 @@ class G_Avgs_file(BaseFile):
     def __init__(self, filename, **kwargs):
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
+        self.nq = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
@@ -903,8 +1348,8 @@ class G_Avgs_file(BaseFile):
         self.iter = []
         for i in range(self.nrec):
             self.val.append(self.get_value("f8", shape=[self.nq]))
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+            self.time.append(self._read_f8())
+            self.iter.append(self._read_i4())
 
 
 class G_Avgs(Rayleigh_Output):
@@ -915,7 +1360,7 @@ class G_Avgs(Rayleigh_Output):
 
     def get_q(self, i, qcode):
         igrid = self.gridpointer[i]
-        return self.val[i][self.qvmap[igrid][qcode]]
+        return self.val[i][self._qcol(qcode, igrid)]
 
     def time_plot(self, q, tunit=None, Clear=False, legend=False, **kwargs):
         fig = plt.gcf()
@@ -946,15 +1391,15 @@ class Shell_Spectra_file(BaseFile):
     def __init__(self, filename, **kwargs):
         super().__init__(filename, **kwargs)
 
-        self.version = self.get_value("i4")
-        self.nrec = self.get_value("i4")
+        self.version = self._read_i4()
+        self.nrec = self._read_i4()
 
-        self.lmax = self.get_value("i4")
+        self.lmax = self._read_i4()
         self.nell = self.lmax + 1
         self.nm = self.nell
         self.mmax = self.nm - 1
-        self.nr = self.get_value("i4")
-        self.nq = self.get_value("i4")
+        self.nr = self._read_i4()
+        self.nq = self._read_i4()
 
         self.qv = self.get_value("i4", shape=[self.nq])
 
@@ -981,8 +1426,8 @@ class Shell_Spectra_file(BaseFile):
                     modifier=modifier,
                 )
             )
-            self.time.append(self.get_value("f8"))
-            self.iter.append(self.get_value("i4"))
+            self.time.append(self._read_f8())
+            self.iter.append(self._read_i4())
 
 
 class Shell_Spectra(Rayleigh_Output):
@@ -1000,7 +1445,7 @@ class Shell_Spectra(Rayleigh_Output):
 
     def get_q(self, i, qcode):
         igrid = self.gridpointer[i]
-        return self.val[i][:, :, :, self.qvmap[igrid][qcode]]
+        return self.val[i][:, :, :, self._qcol(qcode, igrid)]
 
 
 class Shell_Spectra_lpower(Shell_Spectra):
@@ -1056,18 +1501,24 @@ class PDE_Coefficients(BaseFile):
     def __init__(self, filename="equation_coefficients", **kwargs):
         super().__init__(filename, **kwargs)
 
-        file_version = self.get_value("i4")
+        file_version = self._read_i4()
         if self.version != file_version:
             raise NotImplementedError(
                 f"version {file_version} of PDE coefficients is not implemented yet"
             )
-        self.cset = self.get_value("i4", shape=[self.nconst])
-        self.fset = self.get_value("i4", shape=[self.nfunc])
+        # The arrays that can be modified are copied, as data read with mmap is
+        # read-only and in the byte order of the file.
+        self.cset = np.array(self.get_value("i4", shape=[self.nconst]), dtype="i4")
+        self.fset = np.array(self.get_value("i4", shape=[self.nfunc]), dtype="i4")
 
-        self.constants = self.get_value("f8", shape=[self.nconst])
-        self.nr = self.get_value("i4")
+        self.constants = np.array(self.get_value("f8", shape=[self.nconst]), dtype="f8")
+        self.nr = self._read_i4()
         self.radius = self.get_value("f8", shape=[self.nr])
-        self.functions = self.get_value("f8", shape=[self.nr, self.nfunc])
+        # [nr, nfunc], kept in Fortran order so that each function is a
+        # contiguous column
+        self.functions = np.array(
+            self.get_value("f8", shape=[self.nr, self.nfunc]), dtype="f8", order="F"
+        )
 
     @property
     def N2(self):
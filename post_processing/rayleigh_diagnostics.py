@@ -692,7 +692,10 @@ class PDE_Coefficients:
 
         self.dsdr = self.functions[:,14-1]
 
-        self.heating = self.functions[:,6-1]*self.constants[10-1]/self.rho/self.T
+        # func_6 * const_10 / func_1 / func_4, computed in a single buffer
+        self.heating = np.multiply(self.functions[:,6-1], self.constants[10-1])
+        np.divide(self.heating, self.rho, out=self.heating)
+        np.divide(self.heating, self.T, out=self.heating)
 
         self.nu   = self.functions[:,3-1]
         self.dlnu = self.functions[:,11-1]